@@ -1,9 +1,17 @@
 #!/usr/bin/env python3
-import os, re, json, shutil, zipfile, time, hashlib
+import os, re, io, json, shutil, zipfile, time, functools, uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from urllib.parse import urlparse, quote
-from bs4 import BeautifulSoup
+from lxml import html as lxml_html, etree
 from PIL import Image
 import requests
+import xxhash
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+try:
+    import pyvips  # optional (needs libvips): shrink-on-load + multithreaded resize; Pillow is the fallback
+except Exception:
+    pyvips = None
 
 # ----------------- Config -----------------
 CONFIG_DEFAULT = {
@@ -29,19 +37,57 @@ PIL_FORMAT = {
 def pil_format_for(ext: str) -> str:
     return PIL_FORMAT.get(ext.lower(), ext.upper())
 
+WEBP_METHOD = 4  # libwebp effort 0 (fastest) .. 6 (smallest); drop to 0 for speed-priority builds
+
+# Bind format + encoder options once per image instead of re-dispatching per variant
+def pil_saver(ext: str, quality: int):
+    fmt_name = pil_format_for(ext)
+    if fmt_name == "WEBP":
+        opts = dict(quality=quality, method=WEBP_METHOD, lossless=False)
+    elif fmt_name == "JPEG":
+        opts = dict(quality=quality, optimize=False, progressive=False, subsampling=2)
+    elif fmt_name == "PNG":
+        opts = dict(optimize=False, compress_level=1)  # optimize=True re-deflates several times
+    else:
+        opts = {}
+
+    def save(im):
+        buf = io.BytesIO()
+        im.save(buf, fmt_name, **opts)
+        return buf.getvalue()
+    return save
+
 # ----------------- Small utils -----------------
 def ensure_dir(p): os.makedirs(p, exist_ok=True)
 
+_WS_RE = re.compile(r"\s+")
+_UNSAFE_RE = re.compile(r"[^a-z0-9._-]+")
+_DASHES_RE = re.compile(r"-{2,}")
+
 def slugify_name(name: str) -> str:
     name = name.strip().lower()
     name = name.replace("(", "").replace(")", "")
-    name = re.sub(r"\s+", "-", name)
-    name = re.sub(r"[^a-z0-9._-]+", "-", name)
-    name = re.sub(r"-{2,}", "-", name).strip("-")
+    name = _WS_RE.sub("-", name)
+    name = _UNSAFE_RE.sub("-", name)
+    name = _DASHES_RE.sub("-", name).strip("-")
     return name or "asset"
 
-def hash12(b: bytes) -> str:
-    return hashlib.sha1(b).hexdigest()[:12]
+# Content addressing only (not security): xxh3 is far faster than SHA1 and 48 bits
+# of the digest are plenty for this cache.
+def content_hash(b: bytes) -> str:
+    return xxhash.xxh3_64_hexdigest(b)
+
+# The (mtime_ns, size) part of the key makes an edited file miss the cache and get re-hashed
+@functools.lru_cache(maxsize=None)
+def _hash_file(path, mtime_size):
+    h = xxhash.xxh3_64()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""): h.update(chunk)
+    return h.hexdigest()
+
+def file_hash(path):
+    st = os.stat(path)
+    return _hash_file(path, (st.st_mtime_ns, st.st_size))
 
 def load_config(path):
     if path and os.path.exists(path):
@@ -58,57 +104,74 @@ def copy_src(src, outdir):
         if os.path.exists(outdir): shutil.rmtree(outdir)
         shutil.copytree(src, outdir)
 
+def iter_files(root):  # os.scandir recursion -> DirEntry per regular file (no extra stat per entry)
+    dirs = []
+    with os.scandir(root) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False): dirs.append(entry.path)
+            elif entry.is_file(follow_symlinks=False): yield entry
+    for d in dirs:
+        yield from iter_files(d)
+
 def looks_like_html(path):
     try:
         with open(path, "rb") as f:
-            head = f.read(4096).decode("utf-8", errors="ignore").lower()
-        return ("<!doctype html" in head) or ("<html" in head and "</html>" in head)
+            head = f.read(512).lower()
+        return b"<!doctype html" in head or b"<html" in head
     except Exception:
         return False
 
-def find_and_fix_extensionless_html(dist_root):
+# One scandir walk shared by every stage: {"html": [...], "css": [...], "js": [...], "other": [...]}
+def index_tree(dist_root):
+    files = {"html": [], "css": [], "js": [], "other": []}
+    for entry in iter_files(dist_root):
+        ext = os.path.splitext(entry.name)[1].lstrip(".").lower()
+        files[ext if ext in ("html", "css", "js") else "other"].append(entry.path)
+    return files
+
+def find_and_fix_extensionless_html(dist_root, files):  # moves renamed paths into files["html"]
     renamed = {}
-    for dirpath, _, filenames in os.walk(dist_root):
-        for name in filenames:
-            if "." in name: continue
-            full = os.path.join(dirpath, name)
-            if looks_like_html(full):
-                new_full = full + ".html"
-                os.rename(full, new_full)
-                rel_old = os.path.relpath(full, dist_root).replace(os.sep, "/")
-                rel_new = os.path.relpath(new_full, dist_root).replace(os.sep, "/")
-                renamed[rel_old] = rel_new
+    for full in [p for p in files["other"] if "." not in os.path.basename(p)]:
+        if os.path.getsize(full) == 0: continue
+        if looks_like_html(full):
+            new_full = full + ".html"
+            os.rename(full, new_full)
+            files["other"].remove(full)
+            if new_full not in files["html"]: files["html"].append(new_full)  # zip extracted over a previous run
+            rel_old = os.path.relpath(full, dist_root).replace(os.sep, "/")
+            rel_new = os.path.relpath(new_full, dist_root).replace(os.sep, "/")
+            renamed[rel_old] = rel_new
     return renamed
 
-ATTR_PATTERN = re.compile(r'(?P<attr>\b(?:href|src|action)\s*=\s*["\'])(?P<val>[^"\']+)(["\'])', re.IGNORECASE)
-
-def rewrite_links_in_html(file_path, renamed_map, dist_root):
-    with open(file_path, "r", encoding="utf-8", errors="ignore") as f:
-        text = f.read()
-
-    def fix_link(val):
-        if re.match(r'^[a-zA-Z][a-zA-Z0-9+.-]*:', val): return val
-        if val.startswith("#") or val.startswith("data:"): return val
-        norm = val
-        while norm.startswith("./"): norm = norm[2:]
-        norm = norm.lstrip("/")
-        base = norm.split("#",1)[0].split("?",1)[0]
-        if base in renamed_map:
-            prefix = "/" if val.startswith("/") else ""
-            q = ""; h = ""
-            qpos = val.find("?"); hpos = val.find("#")
-            if qpos != -1 and (hpos == -1 or qpos < hpos): q = val[qpos:(hpos if hpos!=-1 else len(val))]
-            if hpos != -1: h = val[hpos:]
-            return prefix + renamed_map[base] + q + h
-        return val
-
-    def repl(m):
-        before = m.group("val"); after = fix_link(before)
-        return m.group("attr") + after + m.group(3)
-
-    new_text = ATTR_PATTERN.sub(repl, text)
-    if new_text != text:
-        with open(file_path, "w", encoding="utf-8") as f: f.write(new_text)
+_SCHEME_RE = re.compile(r'^[a-zA-Z][a-zA-Z0-9+.-]*:')
+LINK_ATTRS = ("href", "src", "action")
+
+def fix_link(val, renamed_map):
+    if _SCHEME_RE.match(val): return val
+    if val.startswith("#") or val.startswith("data:"): return val
+    norm = val
+    while norm.startswith("./"): norm = norm[2:]
+    norm = norm.lstrip("/")
+    base = norm.split("#",1)[0].split("?",1)[0]
+    if base in renamed_map:
+        prefix = "/" if val.startswith("/") else ""
+        q = ""; h = ""
+        qpos = val.find("?"); hpos = val.find("#")
+        if qpos != -1 and (hpos == -1 or qpos < hpos): q = val[qpos:(hpos if hpos!=-1 else len(val))]
+        if hpos != -1: h = val[hpos:]
+        return prefix + renamed_map[base] + q + h
+    return val
+
+def rewrite_links_in_tree(tree, renamed_map):  # mutates the parsed page; -> changed?
+    changed = False
+    for el in tree.xpath("//*[@href or @src or @action]"):
+        for attr in LINK_ATTRS:
+            val = el.get(attr)
+            if not val: continue
+            new_val = fix_link(val, renamed_map)
+            if new_val != val:
+                el.set(attr, new_val); changed = True
+    return changed
 
 # ----------------- Image helpers + manifest -----------------
 def manifest_path(dist_root): return os.path.join(dist_root, "images", "manifest.json")
@@ -118,7 +181,7 @@ def load_manifest(dist_root):
     if os.path.exists(p):
         with open(p, "r", encoding="utf-8") as f:
             return json.load(f)
-    return {"images": {}}  # {hash12: {"original": "...", "variants": [...], "ts": 12345}}
+    return {"images": {}}  # {"hash12:widths:fmt:quality": {"original": "...", "variants": [[480, "..."], ...], "mtime": ns, "ts": 12345}}
 
 def save_manifest(dist_root, manifest):
     ensure_dir(os.path.join(dist_root, "images"))
@@ -129,212 +192,482 @@ def filename_from_url(url):
     name = os.path.basename(urlparse(url).path)
     return name or "asset"
 
+# One keep-alive pool for the whole run: exports mostly hit the same CDN host
+SESSION = requests.Session()
+_ADAPTER = HTTPAdapter(pool_connections=32, pool_maxsize=32, max_retries=Retry(total=3, backoff_factor=0.3))
+SESSION.mount("https://", _ADAPTER)
+SESSION.mount("http://", _ADAPTER)
+
+_DOWNLOADS = {}  # {url: (path, content-hash)} for the current run, filled by prefetch_remote_images
+
 def download_remote_image(url, dest_dir):
-    r = requests.get(url, timeout=30); r.raise_for_status()
-    data = r.content
+    if url in _DOWNLOADS: return _DOWNLOADS[url]
+    _DOWNLOADS[url] = fetch_remote_image(url, dest_dir)
+    return _DOWNLOADS[url]
+
+# Streams to a .part file while hashing, then renames it to its content-addressed name:
+# the body is never held in memory and an interrupted download leaves no half-written image.
+def fetch_remote_image(url, dest_dir):
     ensure_dir(dest_dir)
-    h = hash12(data)
+    hasher = xxhash.xxh3_64()
+    with SESSION.get(url, stream=True, timeout=30) as r:
+        r.raise_for_status()
+        tmp = os.path.join(dest_dir, f".{uuid.uuid4().hex}.part")
+        flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0)
+        fd = os.open(tmp, flags, 0o666)  # umask applies, unlike mkstemp's 0600
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in r.iter_content(1 << 16):
+                    hasher.update(chunk); f.write(chunk)
+        except BaseException:
+            os.remove(tmp); raise
+    h = hasher.hexdigest()[:12]
     base = slugify_name(filename_from_url(url))
     out = os.path.join(dest_dir, f"{h}-{base}")
-    if not os.path.exists(out):
-        with open(out, "wb") as f: f.write(data)
+    if os.path.exists(out): os.remove(tmp)
+    else: os.replace(tmp, out)
     return out, h  # path + content-hash
 
+def _fetch_or_none(args):
+    url, dest_dir = args
+    try:
+        return fetch_remote_image(url, dest_dir)
+    except Exception:
+        return None
+
+def prefetch_remote_images(urls, dest_dir, max_workers=16):
+    urls = [u for u in dict.fromkeys(urls) if u not in _DOWNLOADS]
+    if not urls: return 0
+    with ThreadPoolExecutor(max_workers=max_workers) as ex:
+        for url, res in zip(urls, ex.map(_fetch_or_none, [(u, dest_dir) for u in urls])):
+            if res: _DOWNLOADS[url] = res  # failures are retried (and reported) by the rewrite pass
+    return len(urls)
+
 def import_local_image(local_path, dest_dir):
     ensure_dir(dest_dir)
-    with open(local_path, "rb") as f: data = f.read()
-    h = hash12(data)
+    h = file_hash(local_path)[:12]
     base = slugify_name(os.path.basename(local_path))
     out = os.path.join(dest_dir, f"{h}-{base}")
     if not os.path.exists(out):
-        with open(out, "wb") as f: f.write(data)
+        shutil.copyfile(local_path, out)  # not os.link: a zip re-extract rewrites the source inode
     return out, h
 
-def make_variants(img_path, out_dir, widths, fmt="webp", quality=82):
-    ensure_dir(out_dir); variants = []
-    im = Image.open(img_path)
-    w, h = im.size
-    stem = slugify_name(os.path.splitext(os.path.basename(img_path))[0])
-    ext = fmt if fmt != "keep" else os.path.splitext(img_path)[1].lstrip(".")
-
+def is_remote(url): return url.startswith(("http://", "https://"))
+
+# Protocol-relative refs are fetched over https. The prefetch keys and the rewrite pass's
+# download_remote_image lookups both go through here, so they always agree.
+def absolute_url(src): return "https:" + src if src.startswith("//") else src
+
+def locate_image(src_abs, base_dir, dist_root):  # -> absolute URL or existing local path, else None
+    src_abs = absolute_url(src_abs)
+    if is_remote(src_abs): return src_abs
+    local_candidate = os.path.normpath(os.path.join(base_dir, src_abs))
+    if not os.path.exists(local_candidate):
+        local_candidate = os.path.join(dist_root, src_abs.lstrip("/"))
+    if not os.path.exists(local_candidate):
+        return None
+    return local_candidate
+
+def resolve_image(src_abs, base_dir, dist_root, orig_dir):  # -> (path, content-hash) or None
+    loc = locate_image(src_abs, base_dir, dist_root)
+    if loc is None: return None
+    if is_remote(loc): return download_remote_image(loc, orig_dir)
+    return import_local_image(loc, orig_dir)
+
+def variant_stem_ext(name, fmt):
+    stem = slugify_name(os.path.splitext(name)[0])
+    ext = fmt if fmt != "keep" else os.path.splitext(name)[1].lstrip(".")
+    return stem, ext
+
+# Icons/logos/avatars narrower than every target only get the full-size variant; when that
+# would be a same-format re-encode (or "keep"), hand back the original bytes instead.
+def passthrough_variant(img_bytes, name, widths, fmt):
+    try:
+        with Image.open(io.BytesIO(img_bytes)) as im:  # header only, no decode
+            w, src_format = im.width, im.format
+    except Exception:
+        return None
+    if w > min(widths, default=0): return None
+    stem, ext = variant_stem_ext(name, fmt)
+    if fmt != "keep" and src_format != pil_format_for(ext): return None
+    return [(w, img_bytes, f"{stem}-{w}w.{ext}")]
+
+# Pure (no file I/O) so it can run in a worker process: -> [(width, encoded_bytes, out_name)]
+def make_variants(img_bytes, name, widths, fmt="webp", quality=82):
+    small = passthrough_variant(img_bytes, name, widths, fmt)
+    if small: return small
+    if pyvips is not None:
+        try:
+            return make_variants_vips(img_bytes, name, widths, fmt, quality)
+        except pyvips.Error:
+            pass  # format/options libvips can't handle -> Pillow
+    return make_variants_pil(img_bytes, name, widths, fmt, quality)
+
+def vips_encode(im, ext, quality):
+    ext = ext.lower()
+    if ext == "webp":
+        return im.webpsave_buffer(Q=quality, effort=WEBP_METHOD, strip=True)
+    opts = f"[Q={quality},strip]" if ext in ("jpg", "jpeg", "avif", "heif") else "[strip]"
+    return im.write_to_buffer(f".{ext}{opts}")
+
+def make_variants_vips(img_bytes, name, widths, fmt="webp", quality=82):
+    src = pyvips.Image.new_from_buffer(img_bytes, "", access="sequential")
+    w = src.width
+    stem, ext = variant_stem_ext(name, fmt)
+
+    variants = []
     for target in widths:
         if target >= w: continue
+        # thumbnail_buffer shrinks on load (JPEG/WebP) instead of decoding the full raster;
+        # the huge height bound makes it fit by width only, and no_rotate keeps the stored
+        # orientation (like src and the Pillow path) so widths match the srcset labels.
+        out = pyvips.Image.thumbnail_buffer(img_bytes, target, height=10_000_000, size="down", no_rotate=True)
+        variants.append((target, vips_encode(out, ext, quality), f"{stem}-{target}w.{ext}"))
+
+    largest_name = f"{stem}-{w}w.{ext}"
+    if fmt == "keep":
+        variants.append((w, img_bytes, largest_name))
+    else:
+        variants.append((w, vips_encode(src, ext, quality), largest_name))
+
+    variants.sort(key=lambda t: t[0])
+    return variants
+
+def make_variants_pil(img_bytes, name, widths, fmt="webp", quality=82):
+    variants = []
+    im = Image.open(io.BytesIO(img_bytes))
+    w, h = im.size
+    stem, ext = variant_stem_ext(name, fmt)
+    targets = sorted((t for t in widths if t < w), reverse=True)
+    save = pil_saver(ext, quality)
+
+    # "keep" copies the original bytes for the full-size variant, so the full raster is
+    # never needed: let libjpeg decode at the cheapest DCT scale >= the largest target.
+    if fmt == "keep" and targets and im.format == "JPEG":
+        im.draft(im.mode, (targets[0], max(1, int(h * targets[0] / float(w)))))
+    im.load()
+
+    # Widest first, each step resampling the previous (smaller) result instead of the source
+    prev = im
+    for target in targets:
         ratio = target / float(w)
         size = (target, max(1, int(h * ratio)))
-        im_resized = im.resize(size, Image.LANCZOS)
-        out_path = os.path.join(out_dir, f"{stem}-{target}w.{ext}")
-        save_kwargs = {}
-        if ext.lower() in ("webp", "jpeg", "jpg", "png"):
-            save_kwargs["quality"] = quality
-        im_resized.save(out_path, format=pil_format_for(ext), **save_kwargs)
-        variants.append((target, out_path))
-
-    largest_path = os.path.join(out_dir, f"{stem}-{w}w.{ext}")
+        im_resized = prev.resize(size, Image.LANCZOS)
+        prev = im_resized
+        variants.append((target, save(im_resized), f"{stem}-{target}w.{ext}"))
+
+    largest_name = f"{stem}-{w}w.{ext}"
     if fmt == "keep":
-        shutil.copy2(img_path, largest_path)
+        variants.append((w, img_bytes, largest_name))
     else:
-        im.save(largest_path, format=pil_format_for(ext), quality=quality)
-    variants.append((w, largest_path))
+        variants.append((w, save(im), largest_name))
 
     variants.sort(key=lambda t: t[0])
     return variants
 
-def ensure_variants_with_cache(downloaded_path, content_hash, var_dir, widths, fmt, quality, manifest):
-    entry = manifest["images"].get(content_hash)
-    if entry and all(os.path.exists(p) for p in entry.get("variants", [])):
-        return entry["variants"]
-    pairs = make_variants(downloaded_path, var_dir, widths, fmt, quality)
-    variant_paths = [p for _, p in pairs]
-    manifest["images"][content_hash] = {
+# The pool already runs one worker per core; libvips' own per-image thread pool on top of
+# that would put ~cpu_count² threads on the box, so each worker encodes single-threaded.
+def variant_worker_init():
+    if pyvips is not None: pyvips.concurrency_set(1)
+
+def variant_job(args):  # (img_path, widths, fmt, quality); None on failure
+    img_path, widths, fmt, quality = args
+    try:
+        with open(img_path, "rb") as f: data = f.read()
+        return make_variants(data, os.path.basename(img_path), widths, fmt, quality)
+    except Exception:
+        return None
+
+# Manifest entries are keyed by content AND variant settings, so a config change misses
+def variant_cache_key(content_hash, widths, fmt, quality):
+    return f"{content_hash}:{'-'.join(map(str, widths))}:{fmt}:{quality}"
+
+def cfg_cache_suffix(cfg):
+    return variant_cache_key("", cfg["image_variants"], cfg["image_format"], cfg["quality"])
+
+def newest_mtime(pairs): return max(os.stat(p).st_mtime_ns for _, p in pairs)
+
+def is_pair_list(variants):
+    return isinstance(variants, list) and all(isinstance(v, list) and len(v) == 2 for v in variants)
+
+_VERIFIED = set()  # manifest keys whose files were checked this run
+
+def cached_variants(manifest, key):
+    entry = manifest["images"].get(key)
+    if not entry: return None
+    if key in _VERIFIED: return entry["variants"]
+    try:
+        if newest_mtime(entry["variants"]) != entry.get("mtime"): return None
+    except (OSError, ValueError, TypeError):
+        return None
+    _VERIFIED.add(key)
+    return entry["variants"]
+
+def store_variants(downloaded_path, key, encoded, var_dir, manifest):
+    ensure_dir(var_dir); pairs = []
+    for w, data, out_name in encoded:  # make_variants returns them sorted by width
+        out_path = os.path.join(var_dir, out_name)
+        with open(out_path, "wb") as f: f.write(data)
+        pairs.append([w, out_path])
+    manifest["images"][key] = {
         "original": downloaded_path,
-        "variants": variant_paths,
+        "variants": pairs,
+        "mtime": newest_mtime(pairs),
         "ts": int(time.time())
     }
-    return variant_paths
-
-# ----------------- CSS: url(...) rewriting (largest variant) -----------------
-CSS_URL_RE = re.compile(r'url\((["\']?)([^\)\s]+)\1\)')
+    _VERIFIED.add(key)
+    return pairs
+
+def prune_stale_variants(manifest, cfg):
+    # drop entries built with other settings (or older manifest schemas) and delete their files
+    suffix = cfg_cache_suffix(cfg)
+    images = manifest["images"]
+    current = {k for k, e in images.items() if k.endswith(suffix) and is_pair_list(e.get("variants"))}
+    stale = [k for k in images if k not in current]
+    keep = {p for k in current for _, p in images[k]["variants"]}
+    for k in stale:
+        for v in images.pop(k).get("variants", []):
+            p = v[1] if isinstance(v, list) else v
+            if p in keep: continue
+            try: os.remove(p)
+            except OSError: pass
+    return len(stale)
 
-def rewrite_css_urls(file_path, cfg, dist_root, manifest):
-    with open(file_path, "r", encoding="utf-8", errors="ignore") as f:
-        css = f.read()
+def ensure_variants_with_cache(downloaded_path, content_hash, var_dir, widths, fmt, quality, manifest):
+    key = variant_cache_key(content_hash, widths, fmt, quality)
+    pairs = cached_variants(manifest, key)
+    if pairs is not None:
+        return pairs
+    with open(downloaded_path, "rb") as f: data = f.read()
+    encoded = make_variants(data, os.path.basename(downloaded_path), widths, fmt, quality)
+    return store_variants(downloaded_path, key, encoded, var_dir, manifest)
+
+# Pages repeat the same hero/logo many times; resolve + hash + manifest probe once per run.
+# A repeated (base_dir, src) reference is a single dict lookup (no stat); a different spelling
+# of the same image still shares the entry keyed by its resolved URL/path.
+_URL_CACHE = {}  # {(base_dir, src) or absolute URL or local path: [(width, variant_path)] sorted by width}
+
+def process_one_image_url(src_abs, base_dir, cfg, dist_root, manifest):
+    ref_key = (base_dir, src_abs)
+    if ref_key in _URL_CACHE: return _URL_CACHE[ref_key]
+    loc = locate_image(src_abs, base_dir, dist_root)
+    if loc is None or loc in _URL_CACHE:
+        pairs = _URL_CACHE.get(loc)
+        _URL_CACHE[ref_key] = pairs
+        return pairs
 
-    css_dir = os.path.dirname(file_path)
     img_dir = os.path.join(dist_root, cfg["image_dir"])
     orig_dir = os.path.join(img_dir, "original")
     var_dir = os.path.join(img_dir, "responsive")
+    if is_remote(loc):
+        downloaded, h = download_remote_image(loc, orig_dir)
+    else:
+        downloaded, h = import_local_image(loc, orig_dir)
+
+    pairs = ensure_variants_with_cache(
+        downloaded, h, var_dir,
+        cfg["image_variants"], cfg["image_format"], cfg["quality"],
+        manifest
+    ) or None
+    _URL_CACHE[loc] = _URL_CACHE[ref_key] = pairs
+    return pairs
+
+# ----------------- Variant URLs -----------------
+@functools.lru_cache(maxsize=None)
+def quote_url(path): return quote(path, safe="/:")
+
+# Every variant lives in the responsive dir, so the relative prefix from a page/stylesheet
+# dir is the same for all of them: one relpath + quote per directory pair per run.
+@functools.lru_cache(maxsize=None)
+def rel_url_prefix(target_dir, base_dir):  # quoted "../images/responsive/" ("" if same dir)
+    rel = os.path.relpath(target_dir, base_dir).replace(os.sep, "/")
+    return "" if rel == "." else quote_url(rel) + "/"
+
+def variant_urls(pairs, base_dir):  # -> [(width, quoted URL relative to base_dir)]
+    prefix = rel_url_prefix(os.path.dirname(pairs[0][1]), base_dir)
+    return [(w, prefix + quote_url(os.path.basename(p))) for w, p in pairs]
+
+def srcset_of(urls): return ", ".join(f"{u} {w}w" for w, u in urls)
+
+# ----------------- CSS: url(...) rewriting (largest variant) -----------------
+CSS_URL_RE = re.compile(r'url\((["\']?)([^\)\s]+)\1\)')
 
+def rewrite_css_urls(css, css_dir, cfg, dist_root, manifest):
     def repl(m):
-        src_abs = m.group(2)
-        if src_abs.startswith("//"): src_abs = "https:" + src_abs
         try:
-            if src_abs.startswith(("http://", "https://")):
-                downloaded, h = download_remote_image(src_abs, orig_dir)
-            else:
-                local_candidate = os.path.normpath(os.path.join(css_dir, src_abs))
-                if not os.path.exists(local_candidate):
-                    local_candidate = os.path.join(dist_root, src_abs.lstrip("/"))
-                if not os.path.exists(local_candidate):
-                    return m.group(0)
-                downloaded, h = import_local_image(local_candidate, orig_dir)
-
-            variant_paths = ensure_variants_with_cache(
-                downloaded, h, var_dir,
-                cfg["image_variants"], cfg["image_format"], cfg["quality"],
-                manifest
-            )
-            if not variant_paths:
+            pairs = process_one_image_url(m.group(2), css_dir, cfg, dist_root, manifest)
+            if not pairs:
                 return m.group(0)
 
             # choose the largest variant
-            def width_of(path):
-                mm = re.search(r"-(\d+)w\.", os.path.basename(path))
-                return int(mm.group(1)) if mm else 0
-            largest = max(variant_paths, key=width_of)
-            relv = os.path.relpath(largest, css_dir).replace(os.sep, "/")
-            return f"url({quote(relv, safe='/:')})"
+            return f"url({variant_urls(pairs[-1:], css_dir)[0][1]})"
         except Exception:
             return m.group(0)
 
-    new_css = CSS_URL_RE.sub(repl, css)
-    if new_css != css:
-        with open(file_path, "w", encoding="utf-8") as f: f.write(new_css)
+    return CSS_URL_RE.sub(repl, css)
 
 # ----------------- HTML: <img> and <picture><source> -----------------
-def rewrite_img_tags(file_path, cfg, dist_root, manifest):
-    with open(file_path, "r", encoding="utf-8", errors="ignore") as f:
-        html = f.read()
-    soup = BeautifulSoup(html, "lxml")
+# default_doctype=False: a page without a doctype must not gain libxml2's HTML 4.0 one.
+# Takes the raw bytes (a str with an <?xml encoding=...?> declaration is rejected) and
+# returns None for anything libxml2 can't turn into a document (empty/comment-only pages).
+# (Parsers aren't shareable across threads, hence one per call.)
+def parse_html(data):
+    parser = lxml_html.HTMLParser(encoding="utf-8", default_doctype=False)
+    try:
+        return lxml_html.document_fromstring(data, parser=parser)
+    except (etree.LxmlError, ValueError):
+        return None
+
+# libxml2 doesn't know <source>/<track>/<wbr> are void, so it parses the siblings that follow
+# one as its children (<picture><source><img></source>, <video><source><source></source></source>).
+# Hoist them back out, innermost first, then drop the empty end tag the serializer still
+# writes for them. (fixtures/void-elements.html covers <picture> and <video>.)
+VOID_UNKNOWN_TO_LIBXML2 = "//source | //track | //wbr"
+VOID_END_TAG_RE = re.compile(r'(<(source|track|wbr)\b[^>]*>)</\2>', re.IGNORECASE)
+
+def unnest_void_elements(tree):
+    for el in reversed(tree.xpath(VOID_UNKNOWN_TO_LIBXML2)):
+        if len(el) == 0 and not el.text: continue
+        parent, children, tail = el.getparent(), list(el), el.tail
+        el.text, el.tail = None, el.text
+        idx = parent.index(el)
+        for i, child in enumerate(children):
+            parent.insert(idx + 1 + i, child)  # moves child together with its tail
+        last = children[-1] if children else el
+        last.tail = (last.tail or "") + (tail or "") or None
+
+# Serialize the whole document, not just <html>: keeps the source doctype (if any) and the
+# comments around <html> (e.g. Webflow's "Last Published" stamp).
+def serialize_html(tree, pretty=False):
+    unnest_void_elements(tree)
+    out = etree.tostring(tree.getroottree(), method="html", encoding="unicode", pretty_print=pretty)
+    return VOID_END_TAG_RE.sub(r"\1", out)
+
+# The <img src> and first <source srcset> URL of a page; shared by the rewrite pass and the
+# variant pre-walk so both see the same (entity-decoded, comment-free) values.
+def html_image_refs(tree):  # -> [(element, url)]
+    refs = []
+    for img in tree.xpath("//img[@src]"):
+        src = img.get("src")
+        if src: refs.append((img, src))
+    for source in tree.xpath("//source[@srcset]"):
+        first = source.get("srcset").split(",")[0].strip()
+        if first: refs.append((source, first.split()[0]))
+    return refs
 
+def rewrite_img_tags(tree, html_dir, cfg, dist_root, manifest):  # mutates tree; -> changed?
     changed = False
-    img_dir = os.path.join(dist_root, cfg["image_dir"])
-    orig_dir = os.path.join(img_dir, "original")
-    var_dir = os.path.join(img_dir, "responsive")
-    html_dir = os.path.dirname(file_path)
-
-    def process_one_image_url(src_abs):
-        if src_abs.startswith("//"): src_abs = "https:" + src_abs
-        if src_abs.startswith(("http://", "https://")):
-            downloaded, h = download_remote_image(src_abs, orig_dir)
-        else:
-            local_candidate = os.path.normpath(os.path.join(html_dir, src_abs))
-            if not os.path.exists(local_candidate):
-                local_candidate = os.path.join(dist_root, src_abs.lstrip("/"))
-            if not os.path.exists(local_candidate):
-                return None
-            downloaded, h = import_local_image(local_candidate, orig_dir)
-
-        variant_paths = ensure_variants_with_cache(
-            downloaded, h, var_dir,
-            cfg["image_variants"], cfg["image_format"], cfg["quality"],
-            manifest
-        )
-        if not variant_paths:
-            return None
-
-        pairs = []
-        for p in variant_paths:
-            m = re.search(r"-(\d+)w\.[^.]+$", os.path.basename(p))
-            if m: pairs.append((int(m.group(1)), p))
-        pairs.sort(key=lambda t: t[0])
-        return pairs
-
-    # <img>
-    for img in soup.find_all("img"):
-        if not cfg.get("download_images", True): continue
-        src = img.get("src")
-        if not src: continue
-        pairs = process_one_image_url(src)
+    for el, url in html_image_refs(tree):
+        pairs = process_one_image_url(url, html_dir, cfg, dist_root, manifest)
         if not pairs: continue
 
-        mid = pairs[min(len(pairs)//2, len(pairs)-1)][1]
-        src_rel = os.path.relpath(mid, html_dir).replace(os.sep, "/")
-        src_rel = quote(src_rel, safe="/:")
-
-        srcset_parts = []
-        for w, p in pairs:
-            relv = os.path.relpath(p, html_dir).replace(os.sep, "/")
-            srcset_parts.append(f"{quote(relv, safe='/:')} {w}w")
-
-        img["src"] = src_rel
-        img["srcset"] = ", ".join(srcset_parts)
-        if not img.get("sizes"):
-            img["sizes"] = "(max-width: 1200px) 100vw, 1200px"
+        urls = variant_urls(pairs, html_dir)
+        if el.tag == "img":
+            el.set("src", urls[min(len(urls)//2, len(urls)-1)][1])
+            el.set("srcset", srcset_of(urls))
+            if not el.get("sizes"):
+                el.set("sizes", "(max-width: 1200px) 100vw, 1200px")
+        else:  # <picture><source>
+            el.set("srcset", srcset_of(urls))
         changed = True
 
-    # <picture><source>
-    for source in soup.find_all("source"):
-        if not cfg.get("download_images", True): continue
-        srcset = source.get("srcset")
-        if not srcset: continue
-        first = srcset.split(",")[0].strip()
-        if not first: continue
-        first_url = first.split()[0]
+    return changed
 
-        pairs = process_one_image_url(first_url)
-        if not pairs: continue
+# ----------------- Fused per-file pass (links + images + formatting) -----------------
+# Each HTML/CSS file is read once, transformed in memory and written at most once.
+# Files written formatted are recorded in the format cache so format_code skips them.
+def write_if_changed(file_path, text, new_text, key, formatted_now, format_cache):
+    data = new_text.encode("utf-8")
+    if new_text != text:
+        with open(file_path, "wb") as f: f.write(data)
+    if formatted_now:
+        format_cache_store(format_cache, key, file_path, data)
+
+def process_html_file(file_path, renamed_map, cfg, dist_root, manifest, format_cache=None):
+    with open(file_path, "rb") as f:
+        raw = f.read()
+    text = raw.decode("utf-8", errors="ignore")
+    key = os.path.relpath(file_path, dist_root).replace(os.sep, "/")
+    pretty = cfg.get("format_html", True)
+    images = cfg.get("download_images", True)
+    formatted = format_cache_hit(format_cache, key, file_path)
+
+    new_text = text
+    if text.strip() and (renamed_map or images or (pretty and not formatted)):
+        tree = parse_html(raw)
+        if tree is None: return  # leave unparseable pages exactly as exported
+        changed = rewrite_links_in_tree(tree, renamed_map) if renamed_map else False
+        if images:
+            changed = rewrite_img_tags(tree, os.path.dirname(file_path), cfg, dist_root, manifest) or changed
+        if changed or pretty:
+            new_text = serialize_html(tree, pretty)
+    write_if_changed(file_path, text, new_text, key, pretty, format_cache)
+
+def process_css_file(file_path, cfg, dist_root, manifest, format_cache=None, cssb=None):
+    with open(file_path, "r", encoding="utf-8", errors="ignore") as f:
+        css = f.read()
+    key = os.path.relpath(file_path, dist_root).replace(os.sep, "/")
+    pretty = bool(cfg.get("format_css_js", True) and cssb)
+    formatted = format_cache_hit(format_cache, key, file_path)
 
-        new_parts = []
-        for w, p in pairs:
-            relv = os.path.relpath(p, html_dir).replace(os.sep, "/")
-            new_parts.append(f"{quote(relv, safe='/:')} {w}w")
-        source["srcset"] = ", ".join(new_parts)
-        changed = True
+    new_css = css
+    if cfg.get("download_images", True):
+        new_css = rewrite_css_urls(css, os.path.dirname(file_path), cfg, dist_root, manifest)
+    if pretty and (new_css != css or not formatted):
+        try:
+            new_css = beautify_code(cssb, new_css)
+        except Exception:
+            pretty = False
+    write_if_changed(file_path, css, new_css, key, pretty, format_cache)
+
+# ----------------- Parallel variant pre-build -----------------
+def collect_image_refs(file_path):  # the URLs rewrite_img_tags / rewrite_css_urls will visit
+    if file_path.lower().endswith(".css"):
+        with open(file_path, "r", encoding="utf-8", errors="ignore") as f:
+            return [m.group(2) for m in CSS_URL_RE.finditer(f.read())]
+    with open(file_path, "rb") as f:
+        tree = parse_html(f.read())
+    return [url for _, url in html_image_refs(tree)] if tree is not None else []
+
+def collect_all_image_refs(files):  # -> [(base_dir, ref)]
+    return [(os.path.dirname(fp), ref) for fp in files for ref in collect_image_refs(fp)]
+
+def remote_urls(refs):
+    return [url for url in (absolute_url(ref) for _, ref in refs) if is_remote(url)]
+
+# Encode every uncached image across all cores up front; the (serial, text-only)
+# rewrite passes then find the variants in the manifest.
+def prebuild_variants(refs, cfg, dist_root, manifest):
+    img_dir = os.path.join(dist_root, cfg["image_dir"])
+    orig_dir = os.path.join(img_dir, "original")
+    var_dir = os.path.join(img_dir, "responsive")
 
-    if changed:
-        with open(file_path, "w", encoding="utf-8") as f:
-            f.write(soup.prettify())
+    sources = {}  # {manifest key: downloaded_path}
+    for base_dir, ref in refs:
+        try:
+            resolved = resolve_image(ref, base_dir, dist_root, orig_dir)
+        except Exception:
+            continue
+        if not resolved: continue
+        key = variant_cache_key(resolved[1], cfg["image_variants"], cfg["image_format"], cfg["quality"])
+        if key not in sources and cached_variants(manifest, key) is None:
+            sources[key] = resolved[0]
+    if not sources: return 0
+
+    todo = list(sources.items())
+    jobs = [(p, cfg["image_variants"], cfg["image_format"], cfg["quality"]) for _, p in todo]
+    built = 0
+    with ProcessPoolExecutor(max_workers=os.cpu_count(), initializer=variant_worker_init) as ex:
+        for (key, p), encoded in zip(todo, ex.map(variant_job, jobs, chunksize=4)):
+            if encoded is None: continue  # rewrite pass retries serially and surfaces the error
+            store_variants(p, key, encoded, var_dir, manifest); built += 1
+    return built
 
 # ----------------- Index + formatting (with cache) -----------------
-def ensure_index(dist_root, preferred=""):
+def ensure_index(dist_root, preferred="", html_files=()):
     index_path = os.path.join(dist_root, "index.html")
-    if os.path.exists(index_path): return
-    all_html = []
-    for dirpath, _, filenames in os.walk(dist_root):
-        for n in filenames:
-            if n.lower().endswith(".html"):
-                rel = os.path.relpath(os.path.join(dirpath, n), dist_root).replace(os.sep, "/")
-                all_html.append(rel)
+    if os.path.exists(index_path): return None
+    all_html = [os.path.relpath(p, dist_root).replace(os.sep, "/") for p in html_files]
     cand = ""
     if preferred and any(os.path.basename(p) == preferred for p in all_html):
         cand = next(p for p in all_html if os.path.basename(p) == preferred)
@@ -343,6 +676,7 @@ def ensure_index(dist_root, preferred=""):
     meta = f'<meta http-equiv="refresh" content="0; url={cand}">' if cand else ""
     with open(index_path, "w", encoding="utf-8") as f:
         f.write(f"<!doctype html><html><head><meta charset='utf-8'>{meta}<title>Index</title></head><body><p>Loading… <a href='{cand}'>Continue</a></p></body></html>")
+    return index_path
 
 def format_cache_path(dist_root): return os.path.join(dist_root, ".cache", "format.json")
 
@@ -356,57 +690,97 @@ def save_format_cache(dist_root, cache):
     ensure_dir(os.path.join(dist_root, ".cache"))
     with open(format_cache_path(dist_root), "w", encoding="utf-8") as f: json.dump(cache, f)
 
-def format_code(dist_root, format_html=True, format_css_js=True, format_cache=None):
+# Cache entries are [mtime_ns, size, content-hash]. A matching stat means no read at all;
+# the file is only hashed when the size matches but the mtime moved (touched/copied).
+def format_cache_hit(format_cache, key, path):
+    entry = format_cache.get(key) if format_cache is not None else None
+    if not isinstance(entry, list) or len(entry) != 3: return False
+    st = os.stat(path)
+    if st.st_mtime_ns == entry[0] and st.st_size == entry[1]: return True
+    if st.st_size != entry[1] or file_hash(path) != entry[2]: return False
+    entry[0] = st.st_mtime_ns
+    return True
+
+def format_cache_entry(path, data):  # data = the bytes just written/read
+    st = os.stat(path)
+    return [st.st_mtime_ns, st.st_size, content_hash(data)]
+
+def format_cache_store(format_cache, key, path, data):
+    if format_cache is None: return
+    format_cache[key] = format_cache_entry(path, data)
+
+def load_jsbeautifier():
     try:
         import jsbeautifier
-        have_jsb = True
+        return jsbeautifier
+    except Exception:
+        return None
+
+def load_cssbeautifier():  # separate package; jsbeautifier has no CSS entry point
+    try:
+        import cssbeautifier
+        return cssbeautifier
     except Exception:
-        have_jsb = False
+        return None
 
-    for dirpath, _, filenames in os.walk(dist_root):
-        for n in filenames:
-            p = os.path.join(dirpath, n)
-            low = n.lower()
+def beautify_code(beautifier, txt):  # jsbeautifier or cssbeautifier module
+    opts = beautifier.default_options()
+    opts.end_with_newline = True
+    return beautifier.beautify(txt, opts)
 
-            # current content hash (for caching)
-            try:
-                with open(p, "rb") as f:
-                    cur_hash = hashlib.sha1(f.read()).hexdigest()
-            except Exception:
-                cur_hash = None
+def format_file(p):  # pool worker -> format cache entry for the rewritten file, None on failure
+    low = p.lower()
+    try:
+        if low.endswith(".html"):
+            with open(p, "rb") as f:
+                tree = parse_html(f.read())
+            if tree is None: return None
+            formatted = serialize_html(tree, pretty=True)
+        else:
+            with open(p, "r", encoding="utf-8", errors="ignore") as f:
+                txt = f.read()
+            beautifier = load_cssbeautifier() if low.endswith(".css") else load_jsbeautifier()
+            formatted = beautify_code(beautifier, txt)
+        data = formatted.encode("utf-8")
+        with open(p, "wb") as f:
+            f.write(data)
+        # stat + hash of the bytes we just wrote (no re-read)
+        return format_cache_entry(p, data)
+    except Exception:
+        return None
 
-            key = os.path.relpath(p, dist_root).replace(os.sep, "/")
-            if format_cache is not None and key in format_cache and format_cache[key] == cur_hash:
-                continue
+def format_code(dist_root, format_html=True, format_css_js=True, format_cache=None, files=None):
+    jsb, cssb = load_jsbeautifier(), load_cssbeautifier()
+    if files is None: files = index_tree(dist_root)
 
+    def key_of(p): return os.path.relpath(p, dist_root).replace(os.sep, "/")
+    def pending(paths):
+        out = []
+        for p in paths:
             try:
-                if format_html and low.endswith(".html"):
-                    with open(p, "r", encoding="utf-8", errors="ignore") as f:
-                        soup = BeautifulSoup(f.read(), "html.parser")
-                    with open(p, "w", encoding="utf-8") as f:
-                        f.write(soup.prettify())
-
-                elif format_css_js and have_jsb and (low.endswith(".css") or low.endswith(".js")):
-                    import jsbeautifier
-                    with open(p, "r", encoding="utf-8", errors="ignore") as f:
-                        txt = f.read()
-                    opts = jsbeautifier.default_options()
-                    opts.end_with_newline = True
-                    if low.endswith(".css"):
-                        formatted = jsbeautifier.beautify_css(txt, opts)
-                    else:
-                        formatted = jsbeautifier.beautify(txt, opts)
-                    with open(p, "w", encoding="utf-8") as f:
-                        f.write(formatted)
-
-                # refresh hash after formatting
-                with open(p, "rb") as f:
-                    cur_hash = hashlib.sha1(f.read()).hexdigest()
-                if format_cache is not None and cur_hash:
-                    format_cache[key] = cur_hash
-
-            except Exception:
+                if not format_cache_hit(format_cache, key_of(p), p): out.append(p)
+            except OSError:
                 pass
+        return out
+
+    html_todo = pending(files["html"]) if format_html else []
+    code = (files["css"] if cssb else []) + (files["js"] if jsb else [])
+    code_todo = pending(code) if format_css_js else []
+
+    # main() already pretty-prints HTML/CSS in the fused per-file pass, so only pages that
+    # pass skipped reach html_todo; those are formatted serially here. JS (pure-Python
+    # jsbeautifier) goes to a process pool whose workers return cache entries; only this
+    # thread writes the cache. A handful of files isn't worth spawning the pool for.
+    results = [(p, format_file(p)) for p in html_todo]
+    if len(code_todo) <= 4:
+        results += [(p, format_file(p)) for p in code_todo]
+    else:
+        with ProcessPoolExecutor(max_workers=min(os.cpu_count() or 1, len(code_todo))) as ex:
+            results += zip(code_todo, ex.map(format_file, code_todo, chunksize=4))
+
+    if format_cache is not None:
+        for p, entry in results:
+            if entry: format_cache[key_of(p)] = entry
 
 # ----------------- CLI -----------------
 def main():
@@ -423,33 +797,40 @@ def main():
     manifest = load_manifest(dist_root)
 
     print(">> Copying source..."); copy_src(src, dist_root)
-    print(">> Fixing extensionless HTML..."); renamed = find_and_fix_extensionless_html(dist_root)
+    files = index_tree(dist_root)
+    html_files, css_files = files["html"], files["css"]
+    print(">> Fixing extensionless HTML..."); renamed = find_and_fix_extensionless_html(dist_root, files)
     if renamed: print(f"  - Renamed {len(renamed)} files")
-    print(">> Rewriting intra-site links...")
-    for dirpath, _, filenames in os.walk(dist_root):
-        for n in filenames:
-            if n.lower().endswith(".html"):
-                rewrite_links_in_html(os.path.join(dirpath, n), renamed, dist_root)
-
-    print(">> Ensuring index.html..."); ensure_index(dist_root, cfg.get("preferred_homepage",""))
+    print(">> Ensuring index.html...")
+    index_path = ensure_index(dist_root, cfg.get("preferred_homepage",""), html_files)
+    if index_path: html_files.append(index_path)
+    format_cache = load_format_cache(dist_root)
 
     if cfg.get("download_images", True):
-        print(">> Processing images (HTML)...")
-        for dirpath, _, filenames in os.walk(dist_root):
-            for n in filenames:
-                if n.lower().endswith(".html"):
-                    rewrite_img_tags(os.path.join(dirpath, n), cfg, dist_root, manifest)
-
-        print(">> Processing images (CSS url(...))...")
-        for dirpath, _, filenames in os.walk(dist_root):
-            for n in filenames:
-                if n.lower().endswith(".css"):
-                    rewrite_css_urls(os.path.join(dirpath, n), cfg, dist_root, manifest)
+        pruned = prune_stale_variants(manifest, cfg)
+        if pruned: print(f"  - Dropped {pruned} stale image variant sets")
+        refs = collect_all_image_refs(html_files + css_files)
+        print(">> Downloading remote images...")
+        orig_dir = os.path.join(dist_root, cfg["image_dir"], "original")
+        fetched = prefetch_remote_images(remote_urls(refs), orig_dir)
+        if fetched: print(f"  - Fetched {fetched} URLs")
+
+        print(">> Building image variants...")
+        built = prebuild_variants(refs, cfg, dist_root, manifest)
+        if built: print(f"  - Encoded {built} images")
+
+    print(">> Rewriting HTML (links, images, formatting)...")
+    for p in html_files:
+        process_html_file(p, renamed, cfg, dist_root, manifest, format_cache)
+
+    print(">> Rewriting CSS (url(...), formatting)...")
+    cssb = load_cssbeautifier()
+    for p in css_files:
+        process_css_file(p, cfg, dist_root, manifest, format_cache, cssb)
 
     if cfg.get("format_html", True) or cfg.get("format_css_js", True):
         print(">> Formatting code...")
-        format_cache = load_format_cache(dist_root)
-        format_code(dist_root, cfg.get("format_html", True), cfg.get("format_css_js", True), format_cache)
+        format_code(dist_root, cfg.get("format_html", True), cfg.get("format_css_js", True), format_cache, files)
         save_format_cache(dist_root, format_cache)
 
     save_manifest(dist_root, manifest)